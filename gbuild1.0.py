@@ -1,12 +1,30 @@
 import os
+import sys
 import shutil
+import shlex
+import tempfile
+import uuid
 import subprocess
-import filecmp
-import difflib
 import fnmatch
+import re
 from datetime import datetime
 import tarfile
 import hashlib
+import mmap
+import graphlib
+import asyncio
+import multiprocessing
+import queue
+import atexit
+import logging
+import logging.handlers
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 # =========================
 # Configurações principais
@@ -16,6 +34,9 @@ SANDBOX_DIR = "/tmp/pm-sandbox"
 ETC_NEW_DIR = "/var/lib/pm/etc-new"
 ETC_BACKUP_DIR = "/var/lib/pm/etc-backup"
 LOG_FILE = "/var/log/pm.log"
+CACHE_DIR = "/var/cache/pm"
+ETC_IO_WORKERS = 16
+SAME_FILE_MMAP_LIMIT = 64 << 20
 
 # =========================
 # Logs e cores
@@ -27,12 +48,33 @@ class Colors:
     FAIL = "\033[91m"
     END = "\033[0m"
 
+LEVEL_MAP = {"HEADER": logging.INFO, "OK": logging.INFO, "WARN": logging.WARNING, "FAIL": logging.ERROR}
+
+class ColorFormatter(logging.Formatter):
+    def format(self, record):
+        color = getattr(Colors, getattr(record, "color", "OK"), Colors.OK)
+        return f"{color}{record.getMessage()}{Colors.END}"
+
+# O arquivo de log é aberto uma única vez; as threads de build só
+# enfileiram registros e a escrita acontece na thread do listener
+_file_handler = logging.FileHandler(LOG_FILE, delay=True)
+# Timestamp formatado na thread do listener, a partir de record.created
+_file_handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+_stream_handler = logging.StreamHandler(sys.stdout)
+_stream_handler.setFormatter(ColorFormatter())
+
+_log_queue = queue.SimpleQueue()
+_listener = logging.handlers.QueueListener(_log_queue, _file_handler, _stream_handler)
+_listener.start()
+atexit.register(_listener.stop)
+
+_logger = logging.getLogger("pm")
+_logger.setLevel(logging.INFO)
+_logger.propagate = False
+_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+
 def log(msg, level="OK"):
-    color = getattr(Colors, level, Colors.OK)
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_FILE, "a") as f:
-        f.write(f"{timestamp} - {msg}\n")
-    print(f"{color}{msg}{Colors.END}")
+    _logger.log(LEVEL_MAP.get(level, logging.INFO), msg, extra={"color": level})
 
 # =========================
 # Sandbox
@@ -41,35 +83,280 @@ def prepare_sandbox():
     os.makedirs(SANDBOX_DIR, exist_ok=True)
     log("Sandbox prepared")
 
-def clean_sandbox():
-    if os.path.exists(SANDBOX_DIR):
-        shutil.rmtree(SANDBOX_DIR)
-    log("Sandbox cleaned")
+def clean_sandbox(path=SANDBOX_DIR):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    log(f"Sandbox cleaned: {path}")
 
 # =========================
-# Utilitários
+# Cache endereçado por conteúdo (sha256)
 # =========================
-def download(url, dest):
-    log(f"Downloading {url} -> {dest}")
-    subprocess.run(["curl", "-L", "-o", dest, url], check=True)
+# objects/   tarballs verificados
+# extracted/ árvores já extraídas, copiadas (reflink quando possível) em cada build
+def cas_path(sha256sum):
+    return os.path.join(CACHE_DIR, "objects", sha256sum[:2], sha256sum)
 
-def verify_sha256(path, sha256sum):
+def extracted_path(sha256sum):
+    return os.path.join(CACHE_DIR, "extracted", sha256sum)
+
+async def fetch_one(session, url, sha256sum):
+    dest = cas_path(sha256sum)
+    # Árvores extraídas pelo pipeline de streaming não têm objects/<sha>
+    if os.path.exists(dest) or os.path.isdir(extracted_path(sha256sum)):
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_path = dest + ".part"
+    # Hash calculado durante o download: o arquivo não é relido
     h = hashlib.sha256()
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        with open(tmp_path, "wb") as f:
+            async for chunk in resp.content.iter_chunked(1 << 20):
+                h.update(chunk)
+                f.write(chunk)
+    if h.hexdigest() != sha256sum:
+        os.remove(tmp_path)
+        log(f"SHA256 mismatch for {url}", "FAIL")
+        return
+    os.replace(tmp_path, dest)
+    log(f"Cached {url} -> {dest}")
+
+async def fetch_all(recipes):
+    if aiohttp is None:
+        log("aiohttp not available, skipping tarball prefetch", "WARN")
+        return
+    sources = {r['sha256']: r['urls']['tarball'] for r in recipes.values()}
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16)) as session:
+        results = await asyncio.gather(
+            *(fetch_one(session, url, sha) for sha, url in sources.items()),
+            return_exceptions=True)
+    for url, result in zip(sources.values(), results):
+        if isinstance(result, Exception):
+            log(f"Prefetch failed for {url}: {result}", "WARN")
+
+# =========================
+# Utilitários
+# =========================
+def file_sha256(path):
     with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(65536), b""):
-            h.update(chunk)
-    valid = h.hexdigest() == sha256sum
-    log(f"SHA256 {'valid' if valid else 'invalid'} for {path}")
-    return valid
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        # Python < 3.11: o OpenSSL consome o mapeamento inteiro numa chamada
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as m:
+            return hashlib.sha256(m).hexdigest()
+
+def same_content(a, b, size_a=None, size_b=None):
+    sa = os.stat(a).st_size if size_a is None else size_a
+    sb = os.stat(b).st_size if size_b is None else size_b
+    if sa != sb:
+        return False
+    if sa == 0:
+        return True
+    # Arquivos grandes: comparar digests evita mapear os dois inteiros
+    if sa > SAME_FILE_MMAP_LIMIT:
+        return file_sha256(a) == file_sha256(b)
+    with open(a, "rb") as fa, open(b, "rb") as fb, \
+            mmap.mmap(fa.fileno(), 0, prot=mmap.PROT_READ) as ma, \
+            mmap.mmap(fb.fileno(), 0, prot=mmap.PROT_READ) as mb:
+        return ma[:] == mb[:]
+
+def fast_copy(src, dst):
+    # copy_file_range copia dentro do kernel (reflink em btrfs/xfs)
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            remaining = os.fstat(s.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                if copied == 0:
+                    # Sem progresso antes do fim: não deixa o destino truncado
+                    raise OSError("copy_file_range made no progress")
+                remaining -= copied
+        except (AttributeError, OSError):
+            s.seek(0)
+            d.seek(0)
+            d.truncate()
+            shutil.copyfileobj(s, d, length=1 << 20)
+    shutil.copystat(src, dst)
+
+def iter_files(root):
+    # DirEntry já traz o caminho pronto e guarda o resultado de stat()
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif not entry.is_dir():
+                yield entry
+
+# Descompressores multi-thread, escolhidos pelo magic number do arquivo
+# (os tarballs do cache não têm extensão)
+TAR_DECOMPRESSORS = (
+    (b"\xfd7zXZ\x00", ["xz", "-dc", "-T0"]),
+    (b"\x28\xb5\x2f\xfd", ["zstd", "-dc", "-T0"]),
+)
+
+def tar_decompressor(magic):
+    if not shutil.which("tar"):
+        return None
+    for prefix, cmd in TAR_DECOMPRESSORS:
+        if magic.startswith(prefix) and shutil.which(cmd[0]):
+            return cmd
+    return None
 
 def extract_tarball(tar_path, dest):
     log(f"Extracting {tar_path} -> {dest}")
-    with tarfile.open(tar_path) as tar:
-        tar.extractall(dest)
+    with open(tar_path, "rb") as f:
+        cmd = tar_decompressor(f.read(6))
+    if cmd is None:
+        with tarfile.open(tar_path) as tar:
+            tar.extractall(dest)
+        return
+    decomp = subprocess.Popen(cmd + [tar_path], stdout=subprocess.PIPE)
+    tar = subprocess.Popen(["tar", "-xf", "-", "-C", dest], stdin=decomp.stdout)
+    decomp.stdout.close()
+    tar.wait()
+    decomp.wait()
+    for proc in (tar, decomp):
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+class HashingReader:
+    # Atualiza o sha256 à medida que os bytes passam pelo pipeline
+    def __init__(self, raw):
+        self.raw = raw
+        self.hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.hasher.update(data)
+        return data
+
+def fetch_and_extract(url, sha256sum, dest):
+    # curl | sha256 | descompressor | tar: o tarball passa uma única vez pela memória
+    log(f"Streaming {url} -> {dest}")
+    curl = subprocess.Popen(["curl", "-L", "-sS", "--fail", url], stdout=subprocess.PIPE)
+    reader = HashingReader(curl.stdout)
+    magic = reader.read(6)
+    cmd = tar_decompressor(magic)
+    killed = False
+    if cmd is None:
+        # Sem descompressor externo: grava o tarball e extrai com tarfile depois de verificar
+        tarball_path = os.path.join(dest, ".download.tar")
+        with open(tarball_path, "wb") as f:
+            f.write(magic)
+            shutil.copyfileobj(reader, f, length=1 << 20)
+        procs = [curl]
+    else:
+        decomp = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        tar = subprocess.Popen(["tar", "-xf", "-", "-C", dest], stdin=decomp.stdout)
+        decomp.stdout.close()
+        try:
+            decomp.stdin.write(magic)
+            shutil.copyfileobj(reader, decomp.stdin, length=1 << 20)
+        except BrokenPipeError:
+            curl.kill()
+            killed = True
+        finally:
+            try:
+                decomp.stdin.close()
+            except BrokenPipeError:
+                pass
+        procs = [curl, decomp, tar]
+    curl.stdout.close()
+    for proc in procs:
+        proc.wait()
+    for proc in procs:
+        if proc.returncode and not (proc is curl and killed):
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    valid = reader.hasher.hexdigest() == sha256sum
+    log(f"SHA256 {'valid' if valid else 'invalid'} for {url}")
+    if not valid:
+        shutil.rmtree(dest)
+        return False
+    if cmd is None:
+        extract_tarball(tarball_path, dest)
+        os.remove(tarball_path)
+    return True
+
+def extracted_tree(url, sha256sum):
+    tree = extracted_path(sha256sum)
+    if os.path.isdir(tree):
+        log(f"Using extracted tree {tree}")
+        return tree
+    os.makedirs(os.path.dirname(tree), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f".{sha256sum}.", dir=os.path.dirname(tree))
+    tarball_path = cas_path(sha256sum)
+    try:
+        if os.path.exists(tarball_path):
+            extract_tarball(tarball_path, tmp_dir)
+        elif not fetch_and_extract(url, sha256sum, tmp_dir):
+            return None
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    try:
+        os.rename(tmp_dir, tree)
+    except OSError:
+        # Outro build da mesma receita publicou a árvore primeiro
+        shutil.rmtree(tmp_dir)
+    return tree
+
+def copy_tree(tree, dest):
+    # Cópia real, nunca hardlink: escritas do build no work dir não podem
+    # alcançar o cache. Em btrfs/xfs o reflink torna a cópia quase gratuita.
+    subprocess.run(["cp", "-a", "--reflink=auto", os.path.join(tree, "."), dest], check=True)
 
-def apply_patch(patch_path, work_dir):
+def apply_patch(patch_path, work_dir, sh=None):
     log(f"Applying patch {patch_path}")
-    subprocess.run(["patch", "-p1", "-i", patch_path], cwd=work_dir, check=True)
+    cmd = ["patch", "-p1", "-i", patch_path]
+    if sh is not None:
+        sh.run(cmd, cwd=work_dir)
+    else:
+        subprocess.run(cmd, cwd=work_dir, check=True)
+
+# =========================
+# Shell de build persistente
+# =========================
+class BuildShell:
+    # Um único bash por build: cada passo é uma linha no stdin, seguida de
+    # um marcador com o código de saída, em vez de um fork+exec por comando
+    def __init__(self, cwd):
+        # Saída lida em bytes: compiladores e locales emitem bytes fora do UTF-8
+        self.marker = f"__PM_DONE_{uuid.uuid4().hex}__".encode()
+        self.proc = subprocess.Popen(["bash", "-s"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, cwd=cwd)
+
+    def run(self, args, cwd):
+        line = f"cd {shlex.quote(cwd)} && {shlex.join(args)} </dev/null; echo {self.marker.decode()} $?\n"
+        self.proc.stdin.write(os.fsencode(line))
+        self.proc.stdin.flush()
+        out = sys.stdout.buffer
+        for line in self.proc.stdout:
+            pos = line.find(self.marker)
+            if pos >= 0:
+                out.write(line[:pos])
+                out.flush()
+                status = int(line[pos + len(self.marker):])
+                break
+            # Saída do build aparece à medida que é gerada
+            out.write(line)
+            out.flush()
+        else:
+            raise subprocess.CalledProcessError(self.proc.wait(), args)
+        if status:
+            raise subprocess.CalledProcessError(status, args)
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 # =========================
 # Gerenciamento /etc
@@ -79,55 +366,136 @@ class EtcManager:
         self.ETC_DIR = os.path.join(BASE_DIR, stage_dir, "etc")
         self.ETC_NEW_DIR = ETC_NEW_DIR
         self.ETC_BACKUP_ROOT = ETC_BACKUP_DIR
+        # Última versão distribuída de cada arquivo: base da mescla em três vias.
+        # Uma por stage, pois cada stage avança seu /etc de forma independente
+        self.PRISTINE_DIR = os.path.join(ETC_BACKUP_DIR, "pristine", stage_dir)
         self.MERGE_RULES = {"*.conf":"merge","*.cfg":"merge","*":"keep-local"}
+        # Todos os globs numa única regex; o grupo nomeado que casou indica a
+        # regra (vale a primeira na ordem do dicionário). Nomes em vez de
+        # índices: fnmatch.translate pode gerar grupos próprios (Python <= 3.10)
+        self.MERGE_ACTIONS = {f"r{i}": action for i, action in enumerate(self.MERGE_RULES.values())}
+        self.MERGE_RULES_RE = re.compile("|".join(
+            f"(?P<r{i}>{fnmatch.translate(k)})" for i, k in enumerate(self.MERGE_RULES)))
+
+    def rule_for(self, filename):
+        m = self.MERGE_RULES_RE.match(filename)
+        return self.MERGE_ACTIONS[m.lastgroup] if m else "keep-local"
 
     def backup_file(self, path):
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         rel_path = os.path.relpath(path, self.ETC_DIR)
         backup_dir = os.path.join(self.ETC_BACKUP_ROOT, timestamp, os.path.dirname(rel_path))
         os.makedirs(backup_dir, exist_ok=True)
-        shutil.copy2(path, os.path.join(backup_dir, os.path.basename(path)))
+        fast_copy(path, os.path.join(backup_dir, os.path.basename(path)))
         log(f"Backup created: {path}")
 
-    def merge_files(self, local, new):
-        with open(local) as f1, open(new) as f2:
-            local_lines = f1.readlines()
-            new_lines = f2.readlines()
-        return list(difflib.unified_diff(local_lines, new_lines, fromfile='local', tofile='new'))
+    def save_pristine(self, filename, new_path):
+        pristine_path = os.path.join(self.PRISTINE_DIR, filename)
+        os.makedirs(os.path.dirname(pristine_path), exist_ok=True)
+        fast_copy(new_path, pristine_path)
+
+    def merge_files(self, local, base, new):
+        # Retorna (conteúdo mesclado ou None se o local já está atualizado, conflito)
+        try:
+            result = subprocess.run(["git", "merge-file", "-p", local, base, new], capture_output=True)
+        except FileNotFoundError:
+            # Sem git: resolve apenas os casos em que só um dos lados mudou
+            if same_content(new, base):
+                return None, False
+            if same_content(local, base):
+                with open(new, "rb") as f:
+                    return f.read(), False
+            return None, True
+        # git merge-file: código = número de conflitos, negativo em erro
+        return result.stdout, result.returncode != 0
 
-    def process_file(self, filename, auto=True):
+    def process_file(self, filename, auto=True, entry=None):
         local_path = os.path.join(self.ETC_DIR, filename)
-        new_path = os.path.join(self.ETC_NEW_DIR, filename)
+        new_path = entry.path if entry is not None else os.path.join(self.ETC_NEW_DIR, filename)
+        pristine_path = os.path.join(self.PRISTINE_DIR, filename)
 
-        if not os.path.exists(local_path):
+        try:
+            local_size = os.stat(local_path).st_size
+        except FileNotFoundError:
             os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            shutil.copy2(new_path, local_path)
+            fast_copy(new_path, local_path)
+            self.save_pristine(filename, new_path)
             log(f"Installed new config: {filename}")
             return
 
-        if filecmp.cmp(local_path, new_path, shallow=False):
+        new_size = entry.stat().st_size if entry is not None else None
+        if same_content(local_path, new_path, local_size, new_size):
+            if not os.path.exists(pristine_path):
+                self.save_pristine(filename, new_path)
             return
 
         self.backup_file(local_path)
-        rule = "merge" if filename.endswith((".conf",".cfg")) else "keep-local"
+        rule = self.rule_for(filename)
         if rule == "keep-local":
             log(f"Kept local: {filename}")
         elif rule == "replace":
-            shutil.copy2(new_path, local_path)
+            fast_copy(new_path, local_path)
             log(f"Replaced: {filename}")
         elif rule == "merge":
-            merged_diff = self.merge_files(local_path, new_path)
-            if merged_diff and auto:
-                merged_lines = list(difflib.restore(merged_diff, 1))
-                with open(local_path, "w") as f:
-                    f.writelines(merged_lines)
+            if not auto:
+                return
+            if not os.path.exists(pristine_path):
+                # Instalações anteriores à base: a versão distribuída atual
+                # vira a base, e as próximas atualizações já mesclam
+                log(f"No base version to merge {filename}, kept local and recorded base", "WARN")
+            else:
+                merged, conflict = self.merge_files(local_path, pristine_path, new_path)
+                if conflict:
+                    # A base não avança: a mescla é tentada de novo na próxima atualização
+                    log(f"Merge conflict, kept local: {filename}", "WARN")
+                    return
+                if merged is not None:
+                    with open(local_path, "wb") as f:
+                        f.write(merged)
                 log(f"Merged automatically: {filename}")
+        self.save_pristine(filename, new_path)
+
+    def process_entries(self, entries, auto=True):
+        # stat/open/read de cada arquivo ficam sobrepostos no pool em vez
+        # de serem feitos um a um
+        with ThreadPoolExecutor(max_workers=ETC_IO_WORKERS) as pool:
+            futures = []
+            prefix = len(self.ETC_NEW_DIR.rstrip(os.sep)) + 1
+            for entry in entries:
+                futures.append(pool.submit(self.process_file, entry.path[prefix:], auto=auto, entry=entry))
+        for f in futures:
+            f.result()
 
     def process_all(self, auto=True):
-        for root, dirs, files in os.walk(self.ETC_NEW_DIR):
-            for file in files:
-                rel_path = os.path.relpath(os.path.join(root, file), self.ETC_NEW_DIR)
-                self.process_file(rel_path, auto=auto)
+        if not os.path.isdir(self.ETC_NEW_DIR):
+            return
+        subdirs, top_files = [], []
+        with os.scandir(self.ETC_NEW_DIR) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif not entry.is_dir():
+                    top_files.append(entry)
+        if not subdirs:
+            self.process_entries(top_files, auto=auto)
+            return
+        # Diff/merge é Python puro (preso ao GIL): cada subdiretório de
+        # primeiro nível vai para um processo, os arquivos da raiz ficam aqui.
+        # forkserver: os workers não herdam threads nem pipes deste processo
+        with ProcessPoolExecutor(max_workers=min(len(subdirs), os.cpu_count()),
+                                 mp_context=multiprocessing.get_context("forkserver"),
+                                 initializer=init_etc_worker) as pool:
+            futures = [pool.submit(process_subtree, self, d, auto) for d in subdirs]
+            self.process_entries(top_files, auto=auto)
+        for f in futures:
+            f.result()
+
+def init_etc_worker():
+    # O QueueListener não existe no processo filho: escreve direto nos handlers
+    _logger.handlers = [_file_handler, _stream_handler]
+
+def process_subtree(etc_mgr, subdir, auto=True):
+    etc_mgr.process_entries(iter_files(subdir), auto=auto)
 
 def update_etc(stage_dir):
     etc_mgr = EtcManager(stage_dir)
@@ -147,51 +515,102 @@ def build_package(stage, package, recipe):
     work_dir = os.path.join(SANDBOX_DIR, package)
     os.makedirs(work_dir, exist_ok=True)
 
-    # Download
-    tarball_path = os.path.join(work_dir, package + ".tar.xz")
-    download(recipe['urls']['tarball'], tarball_path)
-    if not verify_sha256(tarball_path, recipe['sha256']):
+    # Download + extract (o cache só contém conteúdo já verificado)
+    tree = extracted_tree(recipe['urls']['tarball'], recipe['sha256'])
+    if tree is None:
         log(f"SHA256 mismatch for {package}", "FAIL")
         return
+    copy_tree(tree, work_dir)
 
-    # Extract
-    extract_tarball(tarball_path, work_dir)
-
-    # Patch
-    for patch in recipe.get('patches', []):
-        apply_patch(patch, work_dir)
-
-    # Build
-    build_type = recipe.get('tipo_build', 'autotools')
-    if build_type == 'autotools':
-        subprocess.run(["./configure"] + recipe.get('configure_opts', []), cwd=work_dir, check=True)
-        subprocess.run(["make", "-j4"], cwd=work_dir, check=True)
-        subprocess.run(["make", "install", f"DESTDIR={BASE_DIR}/{stage}"], cwd=work_dir, check=True)
-    elif build_type == 'python':
-        subprocess.run(["python3", "setup.py", "install", f"--root={BASE_DIR}/{stage}"], cwd=work_dir, check=True)
-    elif build_type == 'meson':
-        build_dir = os.path.join(work_dir, "build")
-        os.makedirs(build_dir, exist_ok=True)
-        subprocess.run(["meson", ".."], cwd=build_dir, check=True)
-        subprocess.run(["ninja", "-C", build_dir], cwd=build_dir, check=True)
-        subprocess.run(["ninja", "-C", build_dir, "install"], cwd=build_dir, check=True)
-    elif build_type == 'rust':
-        subprocess.run(["cargo", "install", "--root", f"{BASE_DIR}/{stage}"], cwd=work_dir, check=True)
+    with BuildShell(work_dir) as sh:
+        # Patch
+        for patch in recipe.get('patches', []):
+            apply_patch(patch, work_dir, sh)
+
+        # Build
+        build_type = recipe.get('tipo_build', 'autotools')
+        if build_type == 'autotools':
+            sh.run(["./configure"] + recipe.get('configure_opts', []), cwd=work_dir)
+            sh.run(["make", "-j4"], cwd=work_dir)
+            sh.run(["make", "install", f"DESTDIR={BASE_DIR}/{stage}"], cwd=work_dir)
+        elif build_type == 'python':
+            sh.run(["python3", "setup.py", "install", f"--root={BASE_DIR}/{stage}"], cwd=work_dir)
+        elif build_type == 'meson':
+            build_dir = os.path.join(work_dir, "build")
+            os.makedirs(build_dir, exist_ok=True)
+            sh.run(["meson", ".."], cwd=build_dir)
+            sh.run(["ninja", "-C", build_dir], cwd=build_dir)
+            sh.run(["ninja", "-C", build_dir, "install"], cwd=build_dir)
+        elif build_type == 'rust':
+            sh.run(["cargo", "install", "--root", f"{BASE_DIR}/{stage}"], cwd=work_dir)
 
     run_hooks(stage, "post_install", package)
-    update_etc(stage)
-    clean_sandbox()
+    clean_sandbox(work_dir)
 
 # =========================
 # Pipeline Stage
 # =========================
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# =========================
+# Índice de receitas (dependências pré-resolvidas)
+# =========================
+@dataclass(frozen=True)
+class RecipeIndex:
+    deps: dict
+    reverse_deps: dict
+    depth: dict
+    rdeps_count: dict
+
+    @classmethod
+    def build(cls, recipes):
+        deps = {p: tuple(d for d in r.get('dependencias_build', []) if d in recipes)
+                for p, r in recipes.items()}
+        reverse_deps = {p: [] for p in recipes}
+        for p, ds in deps.items():
+            for d in ds:
+                reverse_deps[d].append(p)
+        # Levanta graphlib.CycleError se houver ciclo
+        order = tuple(graphlib.TopologicalSorter(deps).static_order())
+
+        # Maior cadeia de dependentes de cada pacote, calculada uma vez
+        # percorrendo a ordem topológica ao contrário
+        depth = {}
+        for p in reversed(order):
+            depth[p] = 1 + max((depth[c] for c in reverse_deps[p]), default=0)
+
+        return cls(deps=deps,
+                   reverse_deps={p: tuple(r) for p, r in reverse_deps.items()},
+                   depth=depth, rdeps_count={p: len(r) for p, r in reverse_deps.items()})
+
 def build_stage(stage, recipes):
-    for package, recipe in recipes.items():
-        deps = recipe.get('dependencias_build', [])
-        for dep in deps:
-            if dep in recipes:
-                build_package(stage, dep, recipes[dep])
-        build_package(stage, package, recipe)
+    try:
+        # Um índice por chamada: receitas alteradas entre stages são relidas
+        index = RecipeIndex.build(recipes)
+    except graphlib.CycleError as e:
+        cycle = " -> ".join(e.args[1])
+        log(f"Dependency cycle detected: {cycle}", "FAIL")
+        raise
+    ts = graphlib.TopologicalSorter(index.deps)
+    ts.prepare()
+
+    asyncio.run(fetch_all(recipes))
+
+    # Caminho crítico primeiro: cadeias mais longas começam antes
+    depth, rdeps_count = index.depth, index.rdeps_count
+
+    futures = {}
+    while ts.is_active():
+        ready = sorted(ts.get_ready(), key=lambda p: (-depth[p], -rdeps_count[p], p))
+        for p in ready:
+            futures[_executor.submit(build_package, stage, p, recipes[p])] = p
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for f in done:
+            f.result()
+            ts.done(futures.pop(f))
+
+    # /etc é atualizado uma vez por stage, fora das threads de build
+    update_etc(stage)
 
 # =========================
 # Exemplo de receitas
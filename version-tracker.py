@@ -1,6 +1,9 @@
 import json
 import os
-from datetime import datetime
+import sys
+import graphlib
+import logging
+from functools import lru_cache
 
 # =========================
 # Configurações
@@ -13,62 +16,99 @@ LOG_FILE = "/var/log/pm.log"
 # =========================
 # Logs
 # =========================
+# Arquivo aberto uma vez; o timestamp é formatado pelo handler
+_file_handler = logging.FileHandler(LOG_FILE, delay=True)
+_file_handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+_stream_handler = logging.StreamHandler(sys.stdout)
+
+_logger = logging.getLogger("pm.versions")
+_logger.setLevel(logging.INFO)
+_logger.propagate = False
+_logger.addHandler(_file_handler)
+_logger.addHandler(_stream_handler)
+
 def log(msg):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_FILE, "a") as f:
-        f.write(f"{timestamp} - {msg}\n")
-    print(msg)
+    _logger.info(msg)
 
 # =========================
 # Classes principais
 # =========================
 class Package:
-    def __init__(self, name, version, url, use_flags=None, update_policy="notify", group=None):
+    __slots__ = ("name", "version", "url", "use_flags", "update_policy", "group", "deps")
+
+    def __init__(self, name, version, url, use_flags=None, update_policy="notify", group=None, deps=None):
         self.name = name
         self.version = version
         self.url = url
         self.use_flags = use_flags or []
         self.update_policy = update_policy  # notify | auto
         self.group = group  # e.g., @core, @desktop
+        self.deps = deps or []  # dependências de build
+
+# =========================
+# Leitura do banco e do manifesto
+# =========================
+# Os caches são indexados por (path, mtime_ns): um arquivo alterado em
+# disco gera uma nova chave, sem necessidade de invalidação manual.
+def file_mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+@lru_cache(maxsize=None)
+def load_installed_packages(path, mtime_ns):
+    entries = []
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.strip().split()
+                if len(parts) >= 2:
+                    entries.append((parts[0], parts[1]))
+    except FileNotFoundError:
+        pass
+    return tuple(entries)
+
+@lru_cache(maxsize=None)
+def load_manifest(path, mtime_ns):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    manifest = {}
+    for pkg_name, info in data.items():
+        manifest[pkg_name] = Package(
+            name=pkg_name,
+            version=info.get("latest"),
+            url=info.get("url"),
+            update_policy=info.get("update_policy", "notify"),
+            group=info.get("group"),
+            deps=info.get("deps")
+        )
+    return manifest
 
 class VersionTracker:
     def __init__(self):
         self.installed_packages = self.load_installed_packages()
         self.manifest = self.load_manifest()
         self.versions = {}
+        self.update_order = []
 
     # -------------------------
     # Carrega pacotes instalados
     # -------------------------
     def load_installed_packages(self):
-        packages = {}
-        if os.path.exists(PACKAGE_DB):
-            with open(PACKAGE_DB) as f:
-                for line in f:
-                    parts = line.strip().split()
-                    if len(parts) >= 2:
-                        name, version = parts[0], parts[1]
-                        packages[name] = Package(name=name, version=version, url="", update_policy="notify")
-        return packages
+        # Objetos novos por instância: update_auto altera a versão instalada
+        entries = load_installed_packages(PACKAGE_DB, file_mtime_ns(PACKAGE_DB))
+        return {name: Package(name=name, version=version, url="", update_policy="notify")
+                for name, version in entries}
 
     # -------------------------
     # Carrega manifesto remoto
     # -------------------------
     def load_manifest(self):
-        if os.path.exists(MANIFESTO_REMOTE):
-            with open(MANIFESTO_REMOTE) as f:
-                data = json.load(f)
-            manifest = {}
-            for pkg_name, info in data.items():
-                manifest[pkg_name] = Package(
-                    name=pkg_name,
-                    version=info.get("latest"),
-                    url=info.get("url"),
-                    update_policy=info.get("update_policy", "notify"),
-                    group=info.get("group")
-                )
-            return manifest
-        return {}
+        return dict(load_manifest(MANIFESTO_REMOTE, file_mtime_ns(MANIFESTO_REMOTE)))
 
     # -------------------------
     # Verifica versões upstream
@@ -76,18 +116,30 @@ class VersionTracker:
     def check_updates(self):
         updates = {}
         for name, pkg in self.installed_packages.items():
-            if name in self.manifest:
-                upstream = self.manifest[name]
-                if pkg.version != upstream.version:
-                    updates[name] = (pkg.version, upstream.version, upstream.update_policy, upstream.group)
+            upstream = self.manifest.get(name)
+            if upstream is not None and pkg.version != upstream.version:
+                updates[name] = (pkg.version, upstream.version, upstream.update_policy, upstream.group)
         self.versions = updates
+        self.update_order = self.build_order(updates)
         return updates
 
+    # -------------------------
+    # Ordem de build das atualizações (dependências primeiro)
+    # -------------------------
+    def build_order(self, updates):
+        graph = {name: [d for d in self.manifest[name].deps if d in updates] for name in sorted(updates)}
+        try:
+            return list(graphlib.TopologicalSorter(graph).static_order())
+        except graphlib.CycleError as e:
+            log(f"Dependency cycle among updates: {' -> '.join(e.args[1])}")
+            return sorted(updates)
+
     # -------------------------
     # Atualiza pacotes automaticamente
     # -------------------------
     def update_auto(self):
-        for name, (old_ver, new_ver, policy, group) in self.versions.items():
+        for name in self.update_order:
+            old_ver, new_ver, policy, group = self.versions[name]
             if policy == "auto":
                 log(f"Updating {name}: {old_ver} → {new_ver} (group {group})")
                 # Aqui chamaria o build do gerenciador para atualizar
@@ -108,7 +160,8 @@ class VersionTracker:
     # Atualiza todos pacotes de um grupo
     # -------------------------
     def update_group(self, group_name):
-        for name, (old_ver, new_ver, policy, group) in self.versions.items():
+        for name in self.update_order:
+            old_ver, new_ver, policy, group = self.versions[name]
             if group == group_name and policy == "auto":
                 log(f"Updating {name} in group {group_name}: {old_ver} → {new_ver}")
                 # Aqui chamaria build_package